@@ -2,12 +2,13 @@ import hashlib
 from typing import Dict, Any, List
 
 
-def build_report(job_id: int, analysis: Dict[str, Any]) -> Dict[str, Any]:
+def build_report(job_id: int, analysis: Dict[str, Any], tier: str = "full") -> Dict[str, Any]:
     issues: List[Dict[str, Any]] = analysis.get("issues", [])
     summary = analysis.get("summary", "")
     llm_output = analysis.get("llm_output", "")
     content = {
         "job_id": job_id,
+        "tier": tier,
         "summary": summary,
         "issues": issues,
         "observations": analysis.get("observations", []),
@@ -1,8 +1,41 @@
 import json
 import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 偵測器分片數：>1 時先編譯一次，再以多個 slither 行程平行跑各組偵測器
+SLITHER_SHARDS = int(os.getenv("SLITHER_SHARDS", "1"))
+# 每 N 次分片執行於背景另跑一次單一行程作為對照，量測實際加速比並寫入 log（0 = 不量測）
+SLITHER_SPEEDUP_SAMPLE_EVERY = int(os.getenv("SLITHER_SPEEDUP_SAMPLE_EVERY", "0"))
+
+# 預覽層使用的快速高風險偵測器（不跑 LLM，數秒內回饋）
+PREVIEW_DETECTORS = [
+    d.strip()
+    for d in os.getenv(
+        "PREVIEW_DETECTORS",
+        "reentrancy-eth,suicidal,arbitrary-send-eth,controlled-delegatecall,unprotected-upgrade,"
+        "tx-origin,uninitialized-state,uninitialized-storage,unchecked-transfer,weak-prng",
+    ).split(",")
+    if d.strip()
+]
+
+_log_lock = threading.Lock()
+_detectors_cache: Optional[List[str]] = None
+_sharded_runs = 0
+_sample_running = False
+
+
+class ShardError(Exception):
+    pass
 
 
 def _basename(path: Any) -> Any:
@@ -56,7 +89,7 @@ def _normalize_issues(slither_json: Dict[str, Any]) -> List[Dict[str, Any]]:
 def _run(cmd: List[str], cwd: Path, log_path: Path) -> subprocess.CompletedProcess:
     proc = subprocess.run(cmd, cwd=str(cwd), capture_output=True, text=True)
     try:
-        with open(log_path, "a", encoding="utf-8") as f:
+        with _log_lock, open(log_path, "a", encoding="utf-8") as f:
             f.write("$ " + " ".join(cmd) + "\n")
             if proc.stdout:
                 f.write(proc.stdout + "\n")
@@ -67,7 +100,148 @@ def _run(cmd: List[str], cwd: Path, log_path: Path) -> subprocess.CompletedProce
     return proc
 
 
-def run_slither(target_dir: str, output_json: str) -> Dict[str, Any]:
+def _list_detectors(cwd: Path, log_path: Path) -> List[str]:
+    global _detectors_cache
+    if _detectors_cache is None:
+        proc = _run(["slither", "--list-detectors-json"], cwd=cwd, log_path=log_path)
+        try:
+            _detectors_cache = [d["check"] for d in json.loads(proc.stdout) if d.get("check")]
+        except Exception:
+            return []
+    return _detectors_cache
+
+
+def _load_json(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {"results": {"detectors": []}}
+
+
+def _sample_speedup(tmp: str, sol_name: str, sharded_sec: float, sharded_issues: int) -> None:
+    """背景對照：於獨立暫存目錄 tmp 以單一行程重跑同一份原始碼，記錄實測加速比；結束後刪除 tmp。"""
+    global _sample_running
+    try:
+        t0 = time.perf_counter()
+        proc = subprocess.run(
+            ["slither", sol_name, "--json", "single.json", "--fail-none"],
+            cwd=tmp,
+            capture_output=True,
+            text=True,
+        )
+        single_sec = time.perf_counter() - t0
+        raw = _load_json(Path(tmp) / "single.json")
+        if proc.returncode != 0 or raw.get("success") is not True:
+            logger.warning(f"Slither speedup sample: single run failed (code {proc.returncode})")
+            return
+        single_issues = len(raw.get("results", {}).get("detectors", []) or [])
+        logger.info(
+            f"Slither speedup sample: sharded {sharded_sec:.2f}s vs single {single_sec:.2f}s"
+            f" → {single_sec / sharded_sec:.2f}x（issues {sharded_issues} vs {single_issues}）"
+        )
+    except Exception as e:
+        logger.warning(f"Slither speedup sample error: {e}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+        with _log_lock:
+            _sample_running = False
+
+
+def _run_sharded(src_dir: Path, sol_files: List[str], out_path: Path, log_path: Path, shards: int) -> Optional[Dict[str, Any]]:
+    """編譯一次匯出 zip，各分片以 --detect 跑不同偵測器組並合併 JSON；無法分片時回傳 None。"""
+    if len(sol_files) != 1:
+        return None
+    detectors = _list_detectors(src_dir, log_path)
+    if len(detectors) < 2:
+        return None
+    shards = min(shards, len(detectors))
+
+    started = time.perf_counter()
+    archive = src_dir / "compiled.zip"
+    _run(["crytic-compile", sol_files[0], "--export-zip", archive.name], cwd=src_dir, log_path=log_path)
+    if not archive.exists():
+        return None
+    compile_sec = time.perf_counter() - started
+
+    # 輪流分配，讓成本較高的偵測器分散到不同分片
+    groups = [detectors[i::shards] for i in range(shards)]
+
+    def run_shard(idx: int) -> Dict[str, Any]:
+        shard_out = src_dir / f"slither.shard{idx}.json"
+        shard_out.unlink(missing_ok=True)  # slither 不覆寫既有 JSON
+        t0 = time.perf_counter()
+        # --fail-none：有 findings 時 exit code 仍為 0，非 0 即代表行程本身失敗
+        proc = _run(
+            ["slither", archive.name, "--detect", ",".join(groups[idx]), "--json", shard_out.name, "--fail-none"],
+            cwd=src_dir,
+            log_path=log_path,
+        )
+        if proc.returncode != 0:
+            raise ShardError(f"shard {idx} exited with code {proc.returncode}")
+        try:
+            raw = json.loads(shard_out.read_text(encoding="utf-8"))
+        except Exception as e:
+            raise ShardError(f"shard {idx} produced no readable JSON: {e}")
+        if raw.get("success") is not True:
+            raise ShardError(f"shard {idx} failed: {raw.get('error')}")
+        return {"raw": raw, "sec": time.perf_counter() - t0}
+
+    # 任一分片失敗即拋出（由 run_slither 改跑單一行程），不合併部分結果
+    with ThreadPoolExecutor(max_workers=shards) as pool:
+        results = list(pool.map(run_shard, range(shards)))
+
+    merged_detectors: List[Dict[str, Any]] = []
+    for r in results:
+        merged_detectors.extend(r["raw"].get("results", {}).get("detectors", []) or [])
+    raw = {"success": True, "error": None, "results": {"detectors": merged_detectors}}
+    out_path.write_text(json.dumps(raw), encoding="utf-8")
+
+    wall_sec = time.perf_counter() - started
+    timing: Dict[str, Any] = {
+        "mode": "sharded",
+        "shards": shards,
+        "compile_sec": round(compile_sec, 3),
+        "shard_sec": [round(r["sec"], 3) for r in results],
+        "wall_sec": round(wall_sec, 3),
+        # 各分片各自重做 parse / IR，此值只反映分片間的平行度，不等於相對單一行程的加速比
+        "parallelism_estimate": round((compile_sec + sum(r["sec"] for r in results)) / wall_sec, 2) if wall_sec > 0 else None,
+    }
+
+    # 實測加速比需另跑單一行程，放到背景執行緒（原始碼複製到暫存目錄），不拖慢本任務；同時最多一個
+    global _sharded_runs, _sample_running
+    with _log_lock:
+        _sharded_runs += 1
+        sample = (
+            SLITHER_SPEEDUP_SAMPLE_EVERY > 0
+            and _sharded_runs % SLITHER_SPEEDUP_SAMPLE_EVERY == 0
+            and not _sample_running
+        )
+        if sample:
+            _sample_running = True
+    if sample:
+        # 工作目錄於本函式返回後即被釋放，先同步複製原始碼
+        tmp = tempfile.mkdtemp(prefix="slither-sample-")
+        try:
+            shutil.copy(src_dir / sol_files[0], tmp)
+            threading.Thread(
+                target=_sample_speedup,
+                args=(tmp, sol_files[0], wall_sec, len(merged_detectors)),
+                daemon=True,
+            ).start()
+        except Exception as e:
+            logger.warning(f"Slither speedup sample error: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            with _log_lock:
+                _sample_running = False
+    return {"issues": _normalize_issues(raw), "raw": raw, "timing": timing}
+
+
+def run_slither(
+    target_dir: str,
+    output_json: str,
+    shards: Optional[int] = None,
+    detectors: Optional[List[str]] = None,
+) -> Dict[str, Any]:
     out_path = Path(output_json)
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -79,17 +253,38 @@ def run_slither(target_dir: str, output_json: str) -> Dict[str, Any]:
         out_path.write_text(json.dumps({"results": {"detectors": []}}), encoding="utf-8")
         return {"issues": [], "raw": {"results": {"detectors": []}}}
 
-    # 僅保留最小參數：--json
-    cmd = ["slither", *sol_files, "--json", str(out_path)]
-    _run(cmd, cwd=src_dir, log_path=log_path)
+    shards = SLITHER_SHARDS if shards is None else shards
+    # 指定偵測器子集（預覽層）時不分片
+    if shards > 1 and not detectors:
+        try:
+            sharded = _run_sharded(src_dir, sol_files, out_path, log_path, shards)
+            if sharded is not None:
+                return sharded
+        except Exception as e:
+            logger.warning(f"Sharded slither failed, falling back to single run: {e}")
+
+    started = time.perf_counter()
+    # 僅保留最小參數：--json；--fail-none 讓非 0 exit code 只代表行程本身失敗
+    out_path.unlink(missing_ok=True)  # slither 不覆寫既有 JSON
+    cmd = ["slither", *sol_files, "--json", str(out_path), "--fail-none"]
+    if detectors:
+        cmd += ["--detect", ",".join(detectors)]
+    proc = _run(cmd, cwd=src_dir, log_path=log_path)
 
+    # 與分片相同的檢查：失敗的執行不可當成「沒有發現問題」
+    if proc.returncode != 0:
+        raise RuntimeError(f"slither exited with code {proc.returncode}")
     try:
         raw = json.loads(out_path.read_text(encoding="utf-8"))
-    except Exception:
-        raw = {"results": {"detectors": []}}
+    except Exception as e:
+        raise RuntimeError(f"slither produced no readable JSON: {e}")
+    if raw.get("success") is not True:
+        raise RuntimeError(f"slither failed: {raw.get('error')}")
 
+    wall_sec = round(time.perf_counter() - started, 3)
     normalized = {
         "issues": _normalize_issues(raw),
         "raw": raw,
+        "timing": {"mode": "single", "shards": 1, "wall_sec": wall_sec},
     }
     return normalized
@@ -1,10 +1,14 @@
 import os
 import json
+import threading
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 BASE = os.getenv("REPORT_ROOT", "./reports")
 
+# 預覽報告與完整報告可能併發寫入；以鎖確保預覽不會覆蓋完整報告
+_save_lock = threading.Lock()
+
 
 def _to_markdown(report: Dict[str, Any]) -> str:
     job_id = report.get("job_id")
@@ -14,7 +18,22 @@ def _to_markdown(report: Dict[str, Any]) -> str:
     report_hash = report.get("report_hash", "")
     llm_output = report.get("llm_output", "")
     lines: List[str] = []
-    lines.append(f"# Audit Report — Job {job_id}")
+    if report.get("tier") == "failed":
+        # 完整審計失敗且尚無預覽：只有失敗說明，沒有任何分析結果
+        lines.append(f"# Audit Failed — Job {job_id}")
+        lines.append("")
+        lines.append(f"> 完整審計失敗（{report.get('fail_reason') or 'unknown'}），本任務可退款；沒有可用的審計結果。")
+        return "\n".join(lines)
+    if report.get("tier") == "preview":
+        lines.append(f"# Audit Report (Preview) — Job {job_id}")
+        lines.append("")
+        lines.append("> 快速預覽：僅含高風險偵測器結果，未經 LLM 分析；完整報告完成後將取代此頁。")
+    elif report.get("tier") == "preview_failed":
+        lines.append(f"# Audit Failed — Job {job_id}")
+        lines.append("")
+        lines.append(f"> 完整審計失敗（{report.get('fail_reason') or 'unknown'}），本任務可退款；以下僅為先前的快速預覽結果，不構成審計報告。")
+    else:
+        lines.append(f"# Audit Report — Job {job_id}")
     lines.append("")
     lines.append("## Summary")
     if summary:
@@ -52,16 +71,55 @@ def _to_markdown(report: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
+def report_tier(job_id: int) -> Optional[str]:
+    json_path = Path(BASE) / f"{job_id}.json"
+    if not json_path.exists():
+        return None
+    try:
+        # 舊版報告沒有 tier 欄位，一律視為完整報告
+        return json.loads(json_path.read_text(encoding="utf-8")).get("tier") or "full"
+    except Exception:
+        return "full"
+
+
 def save_report(job_id: int, report: Dict[str, Any]) -> str:
     base = Path(BASE)
     base.mkdir(parents=True, exist_ok=True)
 
-    # JSON 檔
-    json_path = base / f"{job_id}.json"
-    json_path.write_text(json.dumps(report, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    with _save_lock:
+        # 預覽只能寫入空白或覆蓋預覽；不覆蓋完整報告或已標示失敗的預覽
+        if report.get("tier") == "preview" and report_tier(job_id) not in (None, "preview"):
+            return f"/reports/{job_id}"
+
+        # JSON 檔
+        json_path = base / f"{job_id}.json"
+        json_path.write_text(json.dumps(report, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
 
-    # Markdown 檔
-    md_path = base / f"{job_id}.md"
-    md_path.write_text(_to_markdown(report), encoding="utf-8")
+        # Markdown 檔
+        md_path = base / f"{job_id}.md"
+        md_path.write_text(_to_markdown(report), encoding="utf-8")
 
     return f"/reports/{job_id}"
+
+
+def mark_preview_failed(job_id: int, reason: str) -> bool:
+    """
+    記錄完整審計失敗：已發布的預覽改標為 preview_failed；尚無報告時寫入 failed 紀錄，
+    讓之後才完成的預覽（兩層併發執行時）不會再被發布。回傳是否有變更。
+    """
+    base = Path(BASE)
+    base.mkdir(parents=True, exist_ok=True)
+    with _save_lock:
+        tier = report_tier(job_id)
+        json_path = base / f"{job_id}.json"
+        if tier == "preview":
+            report = json.loads(json_path.read_text(encoding="utf-8"))
+            report["tier"] = "preview_failed"
+        elif tier is None:
+            report = {"job_id": job_id, "tier": "failed", "issues": []}
+        else:
+            return False
+        report["fail_reason"] = reason[:400]
+        json_path.write_text(json.dumps(report, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        (base / f"{job_id}.md").write_text(_to_markdown(report), encoding="utf-8")
+    return True
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, Set
+
+logger = logging.getLogger(__name__)
+
+# 工作目錄根路徑：建議指向 tmpfs（如 /dev/shm/smart-audit）以避開慢速持久磁碟
+ROOT = os.getenv("WORKSPACE_ROOT", os.path.join(os.getcwd(), "tmp"))
+# 單一任務與全體工作目錄的容量上限（MB）
+JOB_QUOTA_MB = int(os.getenv("WORKSPACE_JOB_QUOTA_MB", "64"))
+TOTAL_QUOTA_MB = int(os.getenv("WORKSPACE_TOTAL_QUOTA_MB", "512"))
+# 失敗任務保留時間（秒），供除錯；成功任務結束即刪除
+FAILED_RETENTION_SEC = int(os.getenv("WORKSPACE_FAILED_RETENTION_SEC", str(24 * 3600)))
+GC_INTERVAL_SEC = int(os.getenv("WORKSPACE_GC_INTERVAL_SEC", "300"))
+
+# 只有帶狀態檔的目錄才屬於本模組；ROOT 下其他檔案 / 目錄（ROOT 可能是共用的 tmpfs）一律不計量也不刪除
+STATE_FILE = ".workspace.json"
+
+_active: Set[str] = set()
+_lock = threading.Lock()
+
+
+class WorkspaceQuotaError(Exception):
+    pass
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _write_state(path: Path, state: Dict[str, Any]) -> None:
+    (path / STATE_FILE).write_text(json.dumps(state), encoding="utf-8")
+
+
+def _read_state(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads((path / STATE_FILE).read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _owned_dirs(root: Path):
+    for path in root.iterdir():
+        if path.is_dir() and (path / STATE_FILE).is_file():
+            yield path
+
+
+def _usage(root: Path) -> int:
+    return sum(_dir_size(path) for path in _owned_dirs(root))
+
+
+def _pid_alive(pid: Any) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except (TypeError, ValueError, OSError):
+        return False
+    return True
+
+
+def _in_use(path: Path, state: Dict[str, Any]) -> bool:
+    # 須在持有 _lock 時呼叫；同時考慮本行程與其他 worker 行程（依狀態檔中的 pid）
+    if path.name in _active:
+        return True
+    if state.get("status") == "active":
+        pid = state.get("pid")
+        return pid != os.getpid() and _pid_alive(pid)
+    return False
+
+
+def _evict_failed(limit: int) -> None:
+    """保留中的失敗目錄依完成時間由舊到新刪除，直到總用量低於 limit。"""
+    root = Path(ROOT)
+    retained = []
+    for path in _owned_dirs(root):
+        state = _read_state(path)
+        if state.get("status") == "failed":
+            retained.append((int(state.get("finished_at", 0)), path))
+    # 只計算一次總用量，每淘汰一個目錄扣掉其大小，避免每次都重新走訪整個 ROOT
+    usage = _usage(root)
+    for _finished_at, path in sorted(retained):
+        if usage < limit:
+            return
+        with _lock:
+            if _read_state(path).get("status") != "failed":
+                continue
+            size = _dir_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+        usage -= size
+        logger.info(f"Workspace quota: evicted retained failed workspace {path.name}")
+
+
+def allocate(key: str) -> str:
+    """
+    建立任務工作目錄。總用量達上限時依序：GC、淘汰最舊的失敗保留目錄；
+    仍不足（皆為執行中任務）才拋出 WorkspaceQuotaError。
+    會走訪檔案系統，async 呼叫端須以 asyncio.to_thread 執行（release / check_quota 亦同）。
+    """
+    root = Path(ROOT)
+    root.mkdir(parents=True, exist_ok=True)
+    limit = TOTAL_QUOTA_MB * 1024 * 1024
+    if _usage(root) >= limit:
+        gc()
+        if _usage(root) >= limit:
+            _evict_failed(limit)
+        if _usage(root) >= limit:
+            raise WorkspaceQuotaError(f"total workspace quota exceeded ({TOTAL_QUOTA_MB} MB)")
+
+    path = root / key
+    with _lock:
+        if key in _active:
+            raise WorkspaceQuotaError(f"workspace {key} already in use")
+        _active.add(key)
+    # 重新送出的任務不沿用舊檔案
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+    _write_state(path, {"status": "active", "pid": os.getpid(), "created_at": int(time.time())})
+    return str(path)
+
+
+def check_quota(path: str) -> None:
+    size = _dir_size(Path(path))
+    if size > JOB_QUOTA_MB * 1024 * 1024:
+        raise WorkspaceQuotaError(f"job workspace quota exceeded ({size} bytes > {JOB_QUOTA_MB} MB)")
+
+
+def release(key: str, failed: bool = False) -> None:
+    """任務結束：成功即刪除；失敗則標記並保留 FAILED_RETENTION_SEC 秒。"""
+    path = Path(ROOT) / key
+    try:
+        if failed and FAILED_RETENTION_SEC > 0 and path.exists():
+            _write_state(path, {"status": "failed", "finished_at": int(time.time())})
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+    finally:
+        with _lock:
+            _active.discard(key)
+
+
+def gc() -> int:
+    """清除過期失敗目錄與無人持有的殘留目錄（如行程崩潰遺留），回傳刪除數量；不碰沒有狀態檔的目錄。"""
+    root = Path(ROOT)
+    if not root.is_dir():
+        return 0
+    now = int(time.time())
+    removed = 0
+    for path in _owned_dirs(root):
+        # 檢查與刪除需在同一把鎖內，避免刪掉剛被重新配置的目錄
+        with _lock:
+            state = _read_state(path)
+            if _in_use(path, state):
+                continue
+            if state.get("status") == "failed":
+                if now - int(state.get("finished_at", 0)) < FAILED_RETENTION_SEC:
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    if removed:
+        logger.info(f"Workspace GC removed {removed} dir(s) under {root}")
+    return removed
+
+
+async def gc_loop() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(gc)
+        except Exception as e:
+            logger.error(f"Workspace GC error: {e}")
+        await asyncio.sleep(GC_INTERVAL_SEC)
@@ -0,0 +1,82 @@
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+
+class JobConflictError(Exception):
+    pass
+
+
+def source_hash(source: str) -> str:
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class JobEntry:
+    job_id: int
+    source_hash: str
+    future: asyncio.Future
+    submitted_at: float
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "queued"
+        if self.future.cancelled() or self.future.exception() is not None:
+            return "error"
+        result = self.future.result()
+        return (result or {}).get("status", "done")
+
+
+class JobRegistry:
+    """
+    以 job id 為鍵的 single-flight 登錄表：同一 id 與相同原始碼的重複送出共用同一次執行結果；
+    同一 id 但原始碼不同則拋出 JobConflictError。完成的結果保留 ttl 秒供重試查詢。
+    """
+
+    def __init__(self, ttl: int = 3600):
+        self.ttl = ttl
+        self._entries: Dict[int, JobEntry] = {}
+
+    def _prune(self) -> None:
+        now = time.time()
+        expired = [
+            k for k, e in self._entries.items()
+            if e.future.done() and now - e.submitted_at > self.ttl
+        ]
+        for k in expired:
+            del self._entries[k]
+
+    def get(self, job_id: int, digest: str) -> Optional[JobEntry]:
+        self._prune()
+        entry = self._entries.get(job_id)
+        if entry is not None and entry.status == "error":
+            # 排程前就失敗（例如讀鏈錯誤）者允許重新送出
+            del self._entries[job_id]
+            return None
+        if entry is not None and entry.source_hash != digest:
+            raise JobConflictError(f"job {job_id} already submitted with different source")
+        return entry
+
+    def start(self, job_id: int, digest: str, starter: Callable[[], Awaitable[asyncio.Future]]) -> JobEntry:
+        """登記並啟動一次執行；呼叫端須先以 get() 確認尚無同 id 的登記（兩者之間不可 await）。"""
+        loop = asyncio.get_running_loop()
+        entry = JobEntry(job_id=job_id, source_hash=digest, future=loop.create_future(), submitted_at=time.time())
+        self._entries[job_id] = entry
+
+        async def run() -> None:
+            try:
+                inner = await starter()
+                result = await inner
+                if not entry.future.done():
+                    entry.future.set_result(result)
+            except Exception as e:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+
+        # 無人等待結果時也取出例外，避免 "exception was never retrieved" 警告
+        entry.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        loop.create_task(run())
+        return entry
@@ -3,16 +3,19 @@ import time
 import asyncio
 import sqlite3
 import logging
+import threading
 from contextlib import closing
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
-from fastapi.responses import PlainTextResponse, Response
+from fastapi.responses import PlainTextResponse, Response, JSONResponse
+
+from backend import stats
+from backend.scheduler import AuditScheduler, AuditTask
+from backend.job_registry import JobRegistry, JobConflictError, source_hash
 
 # 讀取 backend/.env（而非預設 cwd 的 .env）
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'), override=True)
@@ -21,12 +24,6 @@ load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'), overrid
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
-# 新增：審計管線模組（改為絕對匯入）
-from backend.audit.slither_runner import run_slither
-from backend.audit.llm_runner import run_llm
-from backend.audit.report_builder import build_report
-from backend.audit.storage import save_report
-
 # Environment
 RPC = os.getenv("RPC", "http://localhost:8545")
 CHAIN_ID = int(os.getenv("CHAIN_ID", "11155111"))
@@ -34,6 +31,28 @@ CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS") or os.getenv("CONTRACT", "0x000
 SERVICE_PK = os.getenv("SERVICE_PK", "")
 REPORT_ROOT = os.getenv("REPORT_ROOT", "./reports")
 INDEX_FROM_BLOCK = int(os.getenv("INDEX_FROM_BLOCK", "0"))
+# 確認深度：head - CONFIRMATIONS 以下的區塊視為 confirmed
+CONFIRMATIONS = int(os.getenv("CONFIRMATIONS", "6"))
+# 保留最近多少個區塊的 hash 以偵測 reorg
+REORG_WINDOW = max(int(os.getenv("REORG_WINDOW", "128")), CONFIRMATIONS + 1)
+# /readyz：索引器落後鏈頭超過此區塊數即視為未就緒
+READY_MAX_LAG = int(os.getenv("READY_MAX_LAG", "20"))
+# /readyz：索引器超過此秒數未成功讀到鏈頭即視為 RPC 不可用
+READY_MAX_STALE_SEC = int(os.getenv("READY_MAX_STALE_SEC", "60"))
+# 審計排程：worker 數、每位使用者同時執行上限、耗時估算（基本秒數 + 每 KB 原始碼秒數）
+AUDIT_CONCURRENCY = int(os.getenv("AUDIT_CONCURRENCY", "2"))
+AUDIT_MAX_PER_USER = int(os.getenv("AUDIT_MAX_PER_USER", "1"))
+AUDIT_BASE_SEC = float(os.getenv("AUDIT_BASE_SEC", "20"))
+AUDIT_SEC_PER_KB = float(os.getenv("AUDIT_SEC_PER_KB", "2"))
+# 預覽層（快速偵測器、無 LLM）預估秒數
+AUDIT_PREVIEW_SEC = float(os.getenv("AUDIT_PREVIEW_SEC", "5"))
+# POST /jobs 等待 JobPaid 出現的最長秒數（前端送出付款交易後即呼叫，交易可能尚未上鏈）
+JOB_PAID_WAIT_SEC = int(os.getenv("JOB_PAID_WAIT_SEC", "30"))
+# 已完成任務結果在登錄表中的保留秒數（重送時直接回傳）
+JOB_RESULT_TTL_SEC = int(os.getenv("JOB_RESULT_TTL_SEC", "3600"))
+# 合約 REFUND_DELAY 讀取失敗時的暫用值；失敗後 REFUND_DELAY_RETRY_SEC 秒內不再重讀鏈上
+REFUND_DELAY_FALLBACK = int(os.getenv("REFUND_DELAY_FALLBACK", "300"))
+REFUND_DELAY_RETRY_SEC = int(os.getenv("REFUND_DELAY_RETRY_SEC", "60"))
 
 # ABI (minimal) for events and jobs mapping getter
 CONTRACT_ABI = [
@@ -89,6 +108,13 @@ CONTRACT_ABI = [
         "stateMutability": "view",
         "type": "function",
     },
+    {
+        "inputs": [],
+        "name": "REFUND_DELAY",
+        "outputs": [{"internalType": "uint256", "name": "", "type": "uint256"}],
+        "stateMutability": "view",
+        "type": "function",
+    },
     {
         "inputs": [
             {"internalType": "uint256", "name": "id", "type": "uint256"},
@@ -142,6 +168,10 @@ CREATE TABLE IF NOT EXISTS meta (
   key TEXT PRIMARY KEY,
   value TEXT
 );
+CREATE TABLE IF NOT EXISTS blocks (
+  number INTEGER PRIMARY KEY,
+  hash TEXT NOT NULL
+);
 """
 
 
@@ -151,27 +181,135 @@ def get_db():
     return conn
 
 
+def _get_meta_int(conn: sqlite3.Connection, key: str) -> Optional[int]:
+    row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return int(row["value"]) if row and row["value"] is not None else None
+
+
+def _set_meta(conn: sqlite3.Connection, key: str, value: Any) -> None:
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
 def _ensure_extra_columns(conn: sqlite3.Connection) -> None:
-    # 動態新增 failed 與 fail_reason 欄位（若不存在）
+    # 動態新增 failed / fail_reason 與 JobRefunded 相關欄位（若不存在）
     cols = {row[1] for row in conn.execute("PRAGMA table_info(cases)").fetchall()}
     if "failed" not in cols:
         conn.execute("ALTER TABLE cases ADD COLUMN failed INTEGER DEFAULT 0")
     if "fail_reason" not in cols:
         conn.execute("ALTER TABLE cases ADD COLUMN fail_reason TEXT")
+    if "refunded" not in cols:
+        conn.execute("ALTER TABLE cases ADD COLUMN refunded INTEGER DEFAULT 0")
+    if "refunded_tx" not in cols:
+        conn.execute("ALTER TABLE cases ADD COLUMN refunded_tx TEXT")
+    if "refunded_block" not in cols:
+        conn.execute("ALTER TABLE cases ADD COLUMN refunded_block INTEGER")
 
 
 def init_db():
     with closing(get_db()) as conn:
         conn.executescript(SCHEMA_SQL)
+        conn.executescript(stats.SCHEMA_SQL)
         _ensure_extra_columns(conn)
+        # 計數定義變更時（如新增 refunded）遞增 stats.VERSION，既有資料庫會全表重算一次
+        if (_get_meta_int(conn, "stats_version") or 0) < stats.VERSION:
+            stats.rebuild(conn)
+            _set_meta(conn, "stats_version", stats.VERSION)
         conn.commit()
 
 
-# Web3 setup
-w3 = Web3(Web3.HTTPProvider(RPC, request_kwargs={"timeout": 30}))
-# Sepolia uses PoA middleware on some providers
-w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-contract = w3.eth.contract(address=Web3.to_checksum_address(CONTRACT_ADDRESS), abi=CONTRACT_ABI)
+def _update_case(conn: sqlite3.Connection, case_id: int, sql: str, params: tuple) -> None:
+    # case 變更與 stats 計數在同一交易內完成；BEGIN IMMEDIATE 避免快照期間被其他寫入者插隊
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    before = stats.snapshot(conn, case_id)
+    conn.execute(sql, params)
+    stats.apply_change(conn, before, stats.snapshot(conn, case_id))
+
+
+def _db_migrated() -> bool:
+    try:
+        with closing(get_db()) as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+            if not {"cases", "meta", "blocks", "stats"} <= tables:
+                return False
+            cols = {row[1] for row in conn.execute("PRAGMA table_info(cases)").fetchall()}
+            return {"failed", "fail_reason"} <= cols
+    except Exception:
+        return False
+
+
+# Web3 setup（延遲建立：web3 匯入與 provider 建構成本高，首次使用時才初始化）
+_w3 = None
+_contract = None
+_chain_lock = threading.Lock()
+
+
+def get_w3():
+    global _w3
+    if _w3 is None:
+        with _chain_lock:
+            if _w3 is None:
+                from web3 import Web3
+                from web3.middleware import geth_poa_middleware
+
+                w3 = Web3(Web3.HTTPProvider(RPC, request_kwargs={"timeout": 30}))
+                # Sepolia uses PoA middleware on some providers
+                w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+                _w3 = w3
+    return _w3
+
+
+def get_contract():
+    global _contract
+    if _contract is None:
+        w3 = get_w3()
+        with _chain_lock:
+            if _contract is None:
+                _contract = w3.eth.contract(address=w3.to_checksum_address(CONTRACT_ADDRESS), abi=CONTRACT_ABI)
+    return _contract
+
+
+_refund_delay: Optional[int] = None
+_refund_delay_retry_at = 0.0
+_refund_delay_lock = threading.Lock()
+
+
+def get_refund_delay() -> int:
+    # REFUND_DELAY 為合約常數，讀取成功後永久快取；失敗時暫用 fallback 並於 REFUND_DELAY_RETRY_SEC 後才重試，
+    # 避免 RPC 異常時每個請求都打一次鏈
+    global _refund_delay, _refund_delay_retry_at
+    if _refund_delay is None and time.time() >= _refund_delay_retry_at:
+        # 同一時間只有一個執行緒讀鏈，其餘直接用 fallback
+        if _refund_delay_lock.acquire(blocking=False):
+            try:
+                if _refund_delay is None and time.time() >= _refund_delay_retry_at:
+                    _refund_delay = int(get_contract().functions.REFUND_DELAY().call())
+            except Exception as e:
+                _refund_delay_retry_at = time.time() + REFUND_DELAY_RETRY_SEC
+                logger.warning(f"REFUND_DELAY read error, using fallback {REFUND_DELAY_FALLBACK}s: {e}")
+            finally:
+                _refund_delay_lock.release()
+    return _refund_delay if _refund_delay is not None else REFUND_DELAY_FALLBACK
+
+
+def cached_refund_delay() -> int:
+    # 請求路徑用：只讀快取、不等待 RPC；尚未取得時排入背景重試（受 REFUND_DELAY_RETRY_SEC 節流）
+    if _refund_delay is None and time.time() >= _refund_delay_retry_at:
+        asyncio.get_running_loop().run_in_executor(None, get_refund_delay)
+    return _refund_delay if _refund_delay is not None else REFUND_DELAY_FALLBACK
+
+
+# 服務帳戶送交易需序列化，避免併發任務取得相同 nonce
+_tx_lock = threading.Lock()
+
+# 審計任務排程器（worker 於 startup 啟動）
+SCHEDULER = AuditScheduler(concurrency=AUDIT_CONCURRENCY, max_per_user=AUDIT_MAX_PER_USER)
+# 任務登錄表：同一 id + 原始碼只執行一次（single-flight）
+JOBS = JobRegistry(ttl=JOB_RESULT_TTL_SEC)
+
+# 索引器進度（供 /readyz 判斷是否追上鏈頭）
+# head_at 為最近一次成功讀到鏈頭的時間，/readyz 以此判斷 RPC 是否正常，不必每次探測都打 RPC
+INDEXER_STATE: Dict[str, Any] = {"last_block": None, "head": None, "head_at": None, "updated_at": None}
 
 
 class Case(BaseModel):
@@ -193,34 +331,117 @@ async def on_startup():
     logger.info(f"Backend startup — RPC={RPC}, CHAIN_ID={CHAIN_ID}, CONTRACT_ADDRESS={CONTRACT_ADDRESS}")
     # backfill then watch
     asyncio.create_task(indexer_main())
+    asyncio.create_task(_workspace_gc_main())
+    # 背景預熱 REFUND_DELAY 快取，/cases 不在請求路徑上讀鏈
+    asyncio.create_task(asyncio.to_thread(get_refund_delay))
+    SCHEDULER.start()
+
+
+async def _workspace_gc_main():
+    from backend.audit import workspace
+
+    await workspace.gc_loop()
 
 
 async def indexer_main():
-    # Backfill
-    try:
-        await backfill_events(INDEX_FROM_BLOCK)
-    except Exception as e:
-        # Log error, continue to watch latest
-        print("Backfill error:", e)
-    # Watch new blocks
-    latest = 0
-    try:
-        latest = w3.eth.block_number
-    except Exception as e:
-        print("RPC not available yet:", e)
-    from_block = max(INDEX_FROM_BLOCK, latest)
+    # 由 meta.last_block 續跑（重啟不必全量回補），每輪先檢查 reorg 再索引新區塊
     while True:
         try:
-            head = w3.eth.block_number
-            if head > from_block:
-                await backfill_events(from_block + 1, head)
-                from_block = head
+            await asyncio.to_thread(_index_step_sync)
         except Exception as e:
             print("Watch error:", e)
         await asyncio.sleep(5)
 
 
+def _chain_hash(w3, number: int, head: int) -> Optional[str]:
+    from web3.exceptions import BlockNotFound
+
+    # 僅「確定不存在」（高於鏈頭 / BlockNotFound）視同分叉；逾時等其他 RPC 錯誤直接拋出，本輪放棄且不動 DB
+    if number > head:
+        return None
+    try:
+        return w3.eth.get_block(number)["hash"].hex()
+    except BlockNotFound:
+        return None
+
+
+def _find_fork_point(w3, conn: sqlite3.Connection, last_block: int, head: int) -> int:
+    """回傳本地紀錄與鏈上一致的最高區塊；無分叉時即 last_block。"""
+    rows = conn.execute(
+        "SELECT number, hash FROM blocks WHERE number<=? ORDER BY number DESC",
+        (last_block,),
+    ).fetchall()
+    if not rows:
+        return last_block
+    for r in rows:
+        if _chain_hash(w3, int(r["number"]), head) == r["hash"]:
+            return int(r["number"])
+    # 分叉深度超出 REORG_WINDOW：退回到紀錄中最舊區塊之前重新索引
+    oldest = int(rows[-1]["number"])
+    logger.warning(f"Reorg deeper than stored window ({REORG_WINDOW} blocks); rolling back to {oldest - 1}")
+    return oldest - 1
+
+
+def _rollback_to(conn: sqlite3.Connection, block: int) -> None:
+    # 只撤銷事件衍生欄位；failed / fail_reason / report_cid 等鏈下審計狀態保留，
+    # 重新索引時 JobPaid 以 upsert 套用回同一列
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    before = stats.snapshot_where(
+        conn, "paid_block>? OR completed_block>? OR refunded_block>?", (block, block, block)
+    )
+    conn.execute("UPDATE cases SET paid_tx=NULL, paid_block=NULL WHERE paid_block>?", (block,))
+    conn.execute(
+        """
+        UPDATE cases
+        SET completed=0, completed_tx=NULL, completed_block=NULL, completed_time=NULL
+        WHERE completed_block>?
+        """,
+        (block,),
+    )
+    conn.execute(
+        "UPDATE cases SET refunded=0, refunded_tx=NULL, refunded_block=NULL WHERE refunded_block>?",
+        (block,),
+    )
+    for case_id, row in before.items():
+        stats.apply_change(conn, row, stats.snapshot(conn, case_id))
+    conn.execute("DELETE FROM blocks WHERE number>?", (block,))
+    _set_meta(conn, "last_block", block)
+    safe = _get_meta_int(conn, "safe_block")
+    if safe is not None and safe > block:
+        _set_meta(conn, "safe_block", block)
+
+
+def _index_step_sync():
+    w3 = get_w3()
+    head = w3.eth.block_number
+    INDEXER_STATE["head"] = head
+    INDEXER_STATE["head_at"] = int(time.time())
+    with closing(get_db()) as conn:
+        last = _get_meta_int(conn, "last_block")
+        if last is not None:
+            fork = _find_fork_point(w3, conn, last, head)
+            if fork < last:
+                logger.warning(f"Reorg detected: rolling back indexed blocks {fork + 1}..{last}")
+                _rollback_to(conn, fork)
+                conn.commit()
+                last = fork
+    if last is None:
+        _backfill_events_sync(INDEX_FROM_BLOCK, head)
+    elif head > last:
+        _backfill_events_sync(last + 1, head)
+    else:
+        INDEXER_STATE["last_block"] = last
+
+
 async def backfill_events(from_block: int, to_block: Optional[int] = None):
+    # RPC 與 SQLite 皆為同步 I/O，移至執行緒以免阻塞事件迴圈（避免與首批請求搶資源）
+    await asyncio.to_thread(_backfill_events_sync, from_block, to_block)
+
+
+def _backfill_events_sync(from_block: int, to_block: Optional[int] = None):
+    w3 = get_w3()
+    contract = get_contract()
     if to_block is None:
         try:
             to_block = w3.eth.block_number
@@ -234,18 +455,50 @@ async def backfill_events(from_block: int, to_block: Optional[int] = None):
     try:
         paid_logs = contract.events.JobPaid().get_logs(fromBlock=from_block, toBlock=to_block)
         completed_logs = contract.events.JobCompleted().get_logs(fromBlock=from_block, toBlock=to_block)
+        refunded_logs = contract.events.JobRefunded().get_logs(fromBlock=from_block, toBlock=to_block)
     except Exception as e:
         print("Log fetch error:", e)
         return
 
+    blocks: Dict[int, Any] = {}
+
+    def get_block(number: int):
+        if number not in blocks:
+            blocks[number] = w3.eth.get_block(number)
+        return blocks[number]
+
+    # 只保留最近 REORG_WINDOW 個區塊的 hash，足以偵測並定位分叉點
+    hash_from = max(from_block, to_block - REORG_WINDOW + 1)
+    hashes = {n: get_block(n)["hash"].hex() for n in range(hash_from, to_block + 1)}
+    for log in [*paid_logs, *completed_logs, *refunded_logs]:
+        # 抓 log 與抓區塊之間若發生 reorg，本輪放棄，下輪重試
+        if get_block(log["blockNumber"])["hash"] != log["blockHash"]:
+            logger.warning(f"Block {log['blockNumber']} changed while indexing; retrying")
+            return
+    # 抓取的區塊須首尾相連（parentHash），否則期間發生過 reorg
+    for n in range(hash_from + 1, to_block + 1):
+        if get_block(n)["parentHash"] != get_block(n - 1)["hash"]:
+            logger.warning(f"Block {n} does not extend block {n - 1} while indexing; retrying")
+            return
+
     with closing(get_db()) as conn:
+        # 新區段須接在已索引的鏈尖上：若 from_block-1 在 _find_fork_point 之後被 reorg 取代，
+        # 本輪不寫入，下輪 _find_fork_point 會偵測到並回退
+        prev = conn.execute("SELECT hash FROM blocks WHERE number=?", (from_block - 1,)).fetchone()
+        if prev is not None and get_block(from_block)["parentHash"].hex() != prev["hash"]:
+            logger.warning(f"Block {from_block} does not extend indexed block {from_block - 1}; retrying")
+            return
         for log in paid_logs:
             args = log["args"]
-            block = w3.eth.get_block(log["blockNumber"])  # for timestamp
-            conn.execute(
+            _update_case(
+                conn,
+                int(args["id"]),
                 """
-                INSERT OR REPLACE INTO cases (id, user, amount, paid_tx, paid_block, paid_time)
-                VALUES (?, ?, ?, ?, ?, COALESCE((SELECT paid_time FROM cases WHERE id=?), ?))
+                INSERT INTO cases (id, user, amount, paid_tx, paid_block, paid_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                  user=excluded.user, amount=excluded.amount, paid_tx=excluded.paid_tx,
+                  paid_block=excluded.paid_block, paid_time=COALESCE(cases.paid_time, excluded.paid_time)
                 """,
                 (
                     int(args["id"]),
@@ -253,14 +506,14 @@ async def backfill_events(from_block: int, to_block: Optional[int] = None):
                     str(args["amount"]),
                     log["transactionHash"].hex(),
                     log["blockNumber"],
-                    int(args["id"]),
-                    block["timestamp"],
+                    get_block(log["blockNumber"])["timestamp"],
                 ),
             )
         for log in completed_logs:
             args = log["args"]
-            block = w3.eth.get_block(log["blockNumber"])  # for timestamp
-            conn.execute(
+            _update_case(
+                conn,
+                int(args["id"]),
                 """
                 UPDATE cases
                 SET completed=1, report_cid=?, completed_tx=?, completed_block=?, completed_time=?
@@ -270,35 +523,110 @@ async def backfill_events(from_block: int, to_block: Optional[int] = None):
                     args["reportCID"],
                     log["transactionHash"].hex(),
                     log["blockNumber"],
-                    block["timestamp"],
+                    get_block(log["blockNumber"])["timestamp"],
                     int(args["id"]),
                 ),
             )
+        for log in refunded_logs:
+            args = log["args"]
+            _update_case(
+                conn,
+                int(args["id"]),
+                "UPDATE cases SET refunded=1, refunded_tx=?, refunded_block=? WHERE id=?",
+                (log["transactionHash"].hex(), log["blockNumber"], int(args["id"])),
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO blocks (number, hash) VALUES (?, ?)",
+            list(hashes.items()),
+        )
+        conn.execute("DELETE FROM blocks WHERE number<=?", (to_block - REORG_WINDOW,))
+        _set_meta(conn, "last_block", to_block)
+        _set_meta(conn, "safe_block", max(0, to_block - CONFIRMATIONS))
         conn.commit()
+    INDEXER_STATE["last_block"] = to_block
+    INDEXER_STATE["head"] = max(INDEXER_STATE["head"] or 0, to_block)
+    INDEXER_STATE["updated_at"] = int(time.time())
+
+
+@app.get("/healthz")
+async def healthz():
+    # 僅代表行程存活；不觸碰 DB / RPC
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # 只讀索引器快取的鏈頭與其時間；RPC 卡住時探測不會佔用執行緒池
+    checks: Dict[str, Any] = {"db": _db_migrated()}
+    head = INDEXER_STATE["head"]
+    head_at = INDEXER_STATE["head_at"]
+    head_age = (int(time.time()) - head_at) if head_at is not None else None
+    checks["rpc"] = head_age is not None and head_age <= READY_MAX_STALE_SEC
+    indexed = INDEXER_STATE["last_block"]
+    lag = (head - indexed) if (head is not None and indexed is not None) else None
+    checks["indexer"] = lag is not None and lag <= READY_MAX_LAG
+    ready = bool(checks["db"] and checks["rpc"] and checks["indexer"])
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "checks": checks,
+        "head": head,
+        "indexed_block": indexed,
+        "lag": lag,
+        "max_lag": READY_MAX_LAG,
+        "head_age_sec": head_age,
+        "max_stale_sec": READY_MAX_STALE_SEC,
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+
+@app.get("/stats")
+async def get_stats(user: Optional[str] = None):
+    # 由計數表直接讀取（O(1)，不掃描 cases）；Refundable 與時間相關，不在此統計
+    with closing(get_db()) as conn:
+        return stats.read(conn, user)
 
 
 @app.get("/cases", response_model=List[Case])
-async def list_cases(user: str, page: int = 1, limit: int = 20):
+async def list_cases(user: str, page: int = 1, limit: int = 20, confirmed: bool = False):
     offset = (page - 1) * limit
     with closing(get_db()) as conn:
-        rows = conn.execute(
-            """
-            SELECT id, amount, paid_time, completed, report_cid
-            FROM cases WHERE LOWER(user)=LOWER(?)
-            ORDER BY (paid_time IS NULL) ASC, paid_time DESC, id DESC
-            LIMIT ? OFFSET ?
-            """,
-            (user, limit, offset),
-        ).fetchall()
+        if confirmed:
+            # confirmed 視圖：只計入深度 >= CONFIRMATIONS 的事件
+            safe = _get_meta_int(conn, "safe_block") or 0
+            rows = conn.execute(
+                """
+                SELECT id, amount, paid_time,
+                       (completed=1 AND completed_block IS NOT NULL AND completed_block<=?) AS completed,
+                       CASE WHEN completed_block<=? THEN report_cid END AS report_cid,
+                       (refunded=1 AND refunded_block IS NOT NULL AND refunded_block<=?) AS refunded
+                FROM cases WHERE LOWER(user)=LOWER(?) AND paid_block IS NOT NULL AND paid_block<=?
+                ORDER BY (paid_time IS NULL) ASC, paid_time DESC, id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (safe, safe, safe, user, safe, limit, offset),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """
+                SELECT id, amount, paid_time, completed, report_cid, refunded
+                FROM cases WHERE LOWER(user)=LOWER(?) AND paid_block IS NOT NULL
+                ORDER BY (paid_time IS NULL) ASC, paid_time DESC, id DESC
+                LIMIT ? OFFSET ?
+                """,
+                (user, limit, offset),
+            ).fetchall()
 
     result: List[Case] = []
     now_ts = int(time.time())
+    refund_delay = cached_refund_delay()
     for r in rows:
         status = "Pending"
-        if r["completed"]:
+        if r["refunded"]:
+            status = "Refunded"
+        elif r["completed"]:
             status = "Completed"
         elif r["paid_time"] is not None:
-            if int(r["paid_time"]) + 15 * 60 <= now_ts:
+            if int(r["paid_time"]) + refund_delay <= now_ts:
                 status = "Refundable"
         result.append(
             Case(
@@ -319,12 +647,13 @@ async def get_case(id: int):
             "SELECT * FROM cases WHERE id=?",
             (id,),
         ).fetchone()
+        safe = _get_meta_int(conn, "safe_block") or 0
     if not row:
         raise HTTPException(status_code=404, detail="Case not found")
 
     # Cross-check on-chain (defensive)
     try:
-        j = contract.functions.jobs(id).call()
+        j = await asyncio.to_thread(get_contract().functions.jobs(id).call)
         onchain = {
             "user": j[0],
             "amount": str(j[1]),
@@ -342,6 +671,11 @@ async def get_case(id: int):
         "paid_time": int(row["paid_time"]) if row["paid_time"] is not None else None,
         "completed": bool(row["completed"]),
         "report_cid": row["report_cid"],
+        "refunded": bool(row["refunded"]),
+        # paid / completed / refunded 事件是否已達確認深度（未達者可能因 reorg 被撤銷）
+        "paid_confirmed": row["paid_block"] is not None and row["paid_block"] <= safe,
+        "completed_confirmed": row["completed_block"] is not None and row["completed_block"] <= safe,
+        "refunded_confirmed": row["refunded_block"] is not None and row["refunded_block"] <= safe,
         "onchain": onchain,
     }
 
@@ -361,10 +695,126 @@ async def get_report(id: int):
 
 
 @app.post("/jobs")
-async def create_job(req: JobRequest):
-    # 啟動審計背景任務
-    asyncio.create_task(audit_and_complete(req.id, req.source))
-    return {"id": req.id, "status": "queued"}
+async def create_job(req: JobRequest, wait: bool = False):
+    digest = source_hash(req.source)
+    try:
+        entry = JOBS.get(req.id, digest)
+        if entry is None:
+            row = _find_paid_case(req.id)
+            if row is None:
+                # 付款交易可能尚未被索引：改查鏈上並短暫等待
+                if not await _wait_job_paid(req.id):
+                    raise HTTPException(status_code=404, detail="JobPaid not found for this id")
+                row = _find_paid_case(req.id)
+            if row is not None and row["refunded"] and not row["completed"]:
+                # 款項已退還，不再花費審計資源（合約 complete() 不檢查退款，只能在此擋下）
+                raise HTTPException(status_code=409, detail="job already refunded")
+            if row is not None and (row["completed"] or row["failed"]):
+                # 已結案的任務不重跑（鏈上已 complete / markFailed）
+                return {
+                    "id": req.id,
+                    "status": "completed" if row["completed"] else "failed",
+                    "report": row["report_cid"],
+                    "fail_reason": row["fail_reason"],
+                    "duplicate": True,
+                }
+            # 等待期間可能已有相同請求登記，需再查一次
+            entry = JOBS.get(req.id, digest)
+            duplicate = entry is not None
+            if entry is None:
+                # 交由排程器依退款期限排序執行
+                entry = JOBS.start(req.id, digest, lambda: enqueue_audit(req.id, req.source))
+        else:
+            duplicate = True
+    except JobConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if duplicate:
+        logger.info(f"[Job {req.id}] 重複送出，沿用進行中 / 已完成的執行")
+    if wait:
+        try:
+            result = await asyncio.shield(entry.future)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"audit error: {e}")
+        return {**result, "duplicate": duplicate}
+    return {"id": req.id, "status": entry.status, "duplicate": duplicate}
+
+
+def _find_paid_case(job_id: int) -> Optional[sqlite3.Row]:
+    with closing(get_db()) as conn:
+        return conn.execute(
+            """
+            SELECT id, completed, failed, fail_reason, report_cid, refunded
+            FROM cases WHERE id=? AND paid_block IS NOT NULL
+            """,
+            (job_id,),
+        ).fetchone()
+
+
+async def _wait_job_paid(job_id: int) -> bool:
+    deadline = time.time() + JOB_PAID_WAIT_SEC
+    while True:
+        if _find_paid_case(job_id) is not None:
+            return True
+        try:
+            j = await asyncio.to_thread(get_contract().functions.jobs(job_id).call)
+            # 退款後 amount 歸零但 paidAt 仍保留：amount == 0 且未完成視為未付款
+            if int(j[1]) > 0 or bool(j[3]):
+                return True
+        except Exception as e:
+            logger.warning(f"[Job {job_id}] jobs() read error: {e}")
+        if time.time() >= deadline:
+            return False
+        await asyncio.sleep(2)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {"scheduler": SCHEDULER.metrics()}
+
+
+def _job_deadline_info(job_id: int) -> Dict[str, Any]:
+    # 優先使用索引資料；尚未索引時改讀鏈上 jobs(id)
+    with closing(get_db()) as conn:
+        row = conn.execute("SELECT user, paid_time FROM cases WHERE id=?", (job_id,)).fetchone()
+    user, paid_time = (row["user"], row["paid_time"]) if row else ("", None)
+    if paid_time is None:
+        try:
+            j = get_contract().functions.jobs(job_id).call()
+            user, paid_time = user or j[0], int(j[2]) or None
+        except Exception as e:
+            logger.warning(f"[Job {job_id}] jobs() read error: {e}")
+    return {
+        "user": str(user or "").lower(),
+        "deadline": int(paid_time or time.time()) + get_refund_delay(),
+    }
+
+
+async def enqueue_audit(job_id: int, source: str) -> asyncio.Future:
+    info = await asyncio.to_thread(_job_deadline_info, job_id)
+    full_cost = AUDIT_BASE_SEC + len(source.encode("utf-8")) / 1024 * AUDIT_SEC_PER_KB
+    # 兩層分析：預覽層成本計入其後的完整審計，slack 必小於同任務的完整審計 → 排在自己的完整審計之前，
+    # 但跨任務仍一律依 slack 排序；若預覽會讓完整審計趕不上退款期限（slack < 0）則直接略過預覽
+    SCHEDULER.submit(AuditTask(
+        job_id=job_id,
+        user=info["user"],
+        deadline=info["deadline"],
+        est_cost=AUDIT_PREVIEW_SEC + full_cost,
+        run=lambda: audit_preview(job_id, source),
+        priority=0,
+        track_deadline=False,
+        droppable=True,
+    ))
+    task = AuditTask(
+        job_id=job_id,
+        user=info["user"],
+        deadline=info["deadline"],
+        est_cost=full_cost,
+        run=lambda: audit_and_complete(job_id, source),
+        priority=1,
+    )
+    logger.info(f"[Job {job_id}] 已排入佇列，deadline={task.deadline}，預估 {task.est_cost:.0f}s")
+    return SCHEDULER.submit(task)
 
 
 def _normalize_pk(pk: str) -> Optional[str]:
@@ -373,35 +823,146 @@ def _normalize_pk(pk: str) -> Optional[str]:
     return pk if pk.startswith("0x") else ("0x" + pk)
 
 
+def _send_service_tx(fn, default_gas: int, timeout: int):
+    w3 = get_w3()
+    acct = w3.eth.account.from_key(_normalize_pk(SERVICE_PK))
+    with _tx_lock:
+        tx = fn.build_transaction({
+            "from": acct.address,
+            "nonce": w3.eth.get_transaction_count(acct.address, "pending"),
+            "chainId": CHAIN_ID,
+        })
+        # Gas 設定：估算 gas，並強制使用 legacy gasPrice 以相容 anvil
+        try:
+            tx["gas"] = w3.eth.estimate_gas(tx)
+        except Exception:
+            tx["gas"] = default_gas
+        tx.pop("maxFeePerGas", None)
+        tx.pop("maxPriorityFeePerGas", None)
+        tx["gasPrice"] = w3.to_wei(1, "gwei")
+        signed = acct.sign_transaction(tx)
+        tx_hash = w3.eth.send_raw_transaction(signed.rawTransaction)
+    return tx_hash, w3.eth.wait_for_transaction_receipt(tx_hash, timeout=timeout)
+
+
+def _mark_preview_failed(job_id: int, reason: str) -> None:
+    # 完整審計失敗時，已發布的預覽報告標示為失敗，避免被誤認為有效審計結果
+    from backend.audit.storage import mark_preview_failed
+
+    try:
+        if mark_preview_failed(job_id, reason):
+            logger.info(f"[Job {job_id}] 預覽報告已標示為審計失敗")
+    except Exception as e:
+        logger.error(f"[Job {job_id}] Mark preview failed error: {e}")
+
+
+async def audit_preview(job_id: int, source: str):
+    # 預覽層：只跑快速高風險偵測器、不呼叫 LLM、不寫 DB 狀態也不上鏈；失敗僅記錄
+    # 注意：預覽在自己的工作目錄內另行編譯，完整審計會再編譯一次（以換取兩層互不干擾）
+    from backend.audit.slither_runner import run_slither, PREVIEW_DETECTORS
+    from backend.audit.report_builder import build_report
+    from backend.audit.storage import save_report, report_tier
+    from backend.audit import workspace
+
+    if report_tier(job_id) not in (None, "preview"):
+        return {"id": job_id, "status": "skipped"}
+    key = f"{job_id}-preview"
+    failed = False
+    try:
+        base = await asyncio.to_thread(workspace.allocate, key)
+        try:
+            with open(os.path.join(base, "Source.sol"), "w", encoding="utf-8") as f:
+                f.write(source)
+            await asyncio.to_thread(workspace.check_quota, base)
+            logger.info(f"[Job {job_id}] 預覽 Slither 開始（{len(PREVIEW_DETECTORS)} detectors）")
+            slither_json = await asyncio.to_thread(
+                run_slither, base, os.path.join(base, "slither.json"), 1, PREVIEW_DETECTORS
+            )
+        except Exception:
+            failed = True
+            raise
+        finally:
+            await asyncio.to_thread(workspace.release, key, failed)
+        analysis = {
+            "summary": source[:2000],
+            "issues": slither_json.get("issues", []),
+            "observations": ["Preview: fast high-impact detectors only, no LLM review."],
+        }
+        report_url = await asyncio.to_thread(save_report, job_id, build_report(job_id, analysis, tier="preview"))
+        logger.info(f"[Job {job_id}] 預覽報告已儲存，URL={report_url}")
+        return {"id": job_id, "status": "preview", "report": report_url}
+    except Exception as e:
+        logger.error(f"[Job {job_id}] Preview error: {e}")
+        return {"id": job_id, "status": "preview_failed", "error": str(e)}
+
+
 async def audit_and_complete(job_id: int, source: str):
-    logger.info(f"[Job {job_id}] 開始審計流程")
-    base = os.path.join(os.getcwd(), "tmp", str(job_id))
-    os.makedirs(base, exist_ok=True)
-    src_path = os.path.join(base, "Source.sol")
+    # 審計模組延遲匯入（首次任務才載入）
+    from backend.audit.slither_runner import run_slither
+    from backend.audit.llm_runner import run_llm
+    from backend.audit.report_builder import build_report
+    from backend.audit.storage import save_report
+    from backend.audit import workspace
 
+    logger.info(f"[Job {job_id}] 開始審計流程")
     failed = False
     fail_reason = ""
 
+    # 工作目錄由 workspace 管理（可置於 tmpfs，含容量上限與背景 GC）
+    base = None
     try:
-        with open(src_path, "w", encoding="utf-8") as f:
-            f.write(source)
-        logger.info(f"[Job {job_id}] 原始碼已寫入 {src_path}")
+        # 配額檢查 / GC / 刪除目錄皆會走訪檔案系統，移至執行緒以免阻塞事件迴圈
+        base = await asyncio.to_thread(workspace.allocate, str(job_id))
     except Exception as e:
         failed = True
-        fail_reason = f"write_source_error: {e}"
-        logger.error(f"[Job {job_id}] Write source error: {e}")
+        fail_reason = f"workspace_error: {e}"
+        logger.error(f"[Job {job_id}] Workspace error: {e}")
 
     slither_json = None
-    if not failed:
-        slither_json_path = os.path.join(base, "slither.json")
+    if base is not None:
         try:
-            logger.info(f"[Job {job_id}] Slither 開始")
-            slither_json = run_slither(base, slither_json_path)
-            logger.info(f"[Job {job_id}] Slither 完成，輸出 {slither_json_path}")
-        except Exception as e:
-            failed = True
-            fail_reason = f"slither_error: {e}"
-            logger.error(f"[Job {job_id}] Slither error: {e}")
+            src_path = os.path.join(base, "Source.sol")
+            try:
+                with open(src_path, "w", encoding="utf-8") as f:
+                    f.write(source)
+                await asyncio.to_thread(workspace.check_quota, base)
+                logger.info(f"[Job {job_id}] 原始碼已寫入 {src_path}")
+            except workspace.WorkspaceQuotaError as e:
+                failed = True
+                fail_reason = f"workspace_error: {e}"
+                logger.error(f"[Job {job_id}] Workspace error: {e}")
+            except Exception as e:
+                failed = True
+                fail_reason = f"write_source_error: {e}"
+                logger.error(f"[Job {job_id}] Write source error: {e}")
+
+            if not failed:
+                slither_json_path = os.path.join(base, "slither.json")
+                try:
+                    logger.info(f"[Job {job_id}] Slither 開始")
+                    slither_json = await asyncio.to_thread(run_slither, base, slither_json_path)
+                    logger.info(f"[Job {job_id}] Slither 完成，輸出 {slither_json_path}")
+                    timing = slither_json.get("timing") or {}
+                    logger.info(
+                        f"[Job {job_id}] Slither 耗時 {timing.get('wall_sec')}s"
+                        f"（mode={timing.get('mode')}, shards={timing.get('shards')}"
+                        + (f", 平行度估計={timing['parallelism_estimate']}x" if timing.get("parallelism_estimate") else "")
+                        + "）"
+                    )
+                except Exception as e:
+                    failed = True
+                    fail_reason = f"slither_error: {e}"
+                    logger.error(f"[Job {job_id}] Slither error: {e}")
+            if not failed:
+                try:
+                    await asyncio.to_thread(workspace.check_quota, base)
+                except workspace.WorkspaceQuotaError as e:
+                    failed = True
+                    fail_reason = f"workspace_error: {e}"
+                    logger.error(f"[Job {job_id}] Workspace error: {e}")
+        finally:
+            # 後續步驟不再需要工作目錄：成功即刪，失敗保留供除錯
+            await asyncio.to_thread(workspace.release, str(job_id), failed)
 
     analysis = None
     if not failed:
@@ -409,7 +970,7 @@ async def audit_and_complete(job_id: int, source: str):
             logger.info(f"[Job {job_id}] LLM 合成開始")
             # 將完整原始碼傳入 LLM，以利補充與剃除誤報
             summary = source
-            analysis = run_llm(summary, slither_json or {"issues": []})
+            analysis = await asyncio.to_thread(run_llm, summary, slither_json or {"issues": []})
             llm_mode = analysis.get("llm_mode", "degraded")
             if llm_mode != "llm":
                 # 任何 LLM 非正常模式一律視為失敗
@@ -423,82 +984,61 @@ async def audit_and_complete(job_id: int, source: str):
             fail_reason = f"llm_exception: {e}"
             logger.error(f"[Job {job_id}] LLM exception: {e}")
 
+    contract = get_contract()
+
     # 若任一步驟失敗：標記 failed，跳過報告與上鏈 complete
     if failed:
         # on-chain markFailed（若有 SERVICE_PK）
         if SERVICE_PK:
             try:
-                pk = _normalize_pk(SERVICE_PK)
-                acct = w3.eth.account.from_key(pk)
                 logger.info(f"[Job {job_id}] markFailed() 準備送出，contract={CONTRACT_ADDRESS}")
-                tx = contract.functions.markFailed(job_id, fail_reason).build_transaction({
-                    "from": acct.address,
-                    "nonce": w3.eth.get_transaction_count(acct.address),
-                    "chainId": CHAIN_ID,
-                })
-                try:
-                    tx["gas"] = w3.eth.estimate_gas(tx)
-                except Exception:
-                    tx["gas"] = 200000
-                tx.pop("maxFeePerGas", None)
-                tx.pop("maxPriorityFeePerGas", None)
-                tx["gasPrice"] = w3.to_wei(1, "gwei")
-                signed = acct.sign_transaction(tx)
-                tx_hash = w3.eth.send_raw_transaction(signed.rawTransaction)
+                tx_hash, _ = await asyncio.to_thread(
+                    _send_service_tx, contract.functions.markFailed(job_id, fail_reason), 200000, 60
+                )
                 logger.info(f"[Job {job_id}] markFailed() 已送出，tx={tx_hash.hex()}")
-                _ = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=60)
             except Exception as e:
                 logger.error(f"[Job {job_id}] markFailed tx error: {e}")
         with closing(get_db()) as conn:
-            conn.execute(
+            _update_case(
+                conn,
+                job_id,
                 "UPDATE cases SET failed=1, fail_reason=? WHERE id=?",
                 (fail_reason[:400], job_id),
             )
             conn.commit()
+        _mark_preview_failed(job_id, fail_reason)
         logger.info(f"[Job {job_id}] 已標記 failed（{fail_reason}），跳過上鏈完成；使用者可退款（依合約規則）")
-        return
+        return {"id": job_id, "status": "failed", "fail_reason": fail_reason}
 
     # 4) 產報告並儲存（僅在成功時）
     logger.info(f"[Job {job_id}] 報告彙整開始")
     report = build_report(job_id, analysis or {})
     try:
-        report_url = save_report(job_id, report)
+        report_url = await asyncio.to_thread(save_report, job_id, report)
         logger.info(f"[Job {job_id}] 報告已儲存，URL={report_url}")
     except Exception as e:
         # 將儲存失敗也視為失敗，不進行完成上鏈
         with closing(get_db()) as conn:
-            conn.execute(
+            _update_case(
+                conn,
+                job_id,
                 "UPDATE cases SET failed=1, fail_reason=? WHERE id=?",
                 (f"save_report_error: {e}"[:400], job_id),
             )
             conn.commit()
         logger.error(f"[Job {job_id}] Save report error: {e}")
-        return
+        _mark_preview_failed(job_id, f"save_report_error: {e}")
+        return {"id": job_id, "status": "failed", "fail_reason": f"save_report_error: {e}"}
 
     # 5) 上鏈標記 complete（若有 SERVICE_PK）
     completed_onchain = False
     if SERVICE_PK:
         try:
-            pk = _normalize_pk(SERVICE_PK)
-            acct = w3.eth.account.from_key(pk)
             logger.info(f"[Job {job_id}] complete() 準備送出，contract={CONTRACT_ADDRESS}")
-            tx = contract.functions.complete(job_id, report_url).build_transaction({
-                "from": acct.address,
-                "nonce": w3.eth.get_transaction_count(acct.address),
-                "chainId": CHAIN_ID,
-            })
-            # Gas 設定：估算 gas，並強制使用 legacy gasPrice 以相容 anvil
-            try:
-                tx["gas"] = w3.eth.estimate_gas(tx)
-            except Exception:
-                tx["gas"] = 300000
-            tx.pop("maxFeePerGas", None)
-            tx.pop("maxPriorityFeePerGas", None)
-            tx["gasPrice"] = w3.to_wei(1, "gwei")
-            signed = acct.sign_transaction(tx)
-            tx_hash = w3.eth.send_raw_transaction(signed.rawTransaction)
+            tx_hash, receipt = await asyncio.to_thread(
+                _send_service_tx, contract.functions.complete(job_id, report_url), 300000, 180
+            )
             logger.info(f"[Job {job_id}] complete() 已送出，tx={tx_hash.hex()}")
-            receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=180)
             completed_onchain = (receipt.status == 1)
             logger.info(f"[Job {job_id}] 上鏈完成狀態={completed_onchain}")
         except Exception as e:
@@ -508,7 +1048,9 @@ async def audit_and_complete(job_id: int, source: str):
     with closing(get_db()) as conn:
         if completed_onchain:
             now_ts = int(time.time())
-            conn.execute(
+            _update_case(
+                conn,
+                job_id,
                 """
                 UPDATE cases SET completed=1, report_cid=? , completed_time=? WHERE id=?
                 """,
@@ -523,6 +1065,7 @@ async def audit_and_complete(job_id: int, source: str):
             logger.info(f"[Job {job_id}] DB 已更新 report_cid（未上鏈完成）")
         conn.commit()
     logger.info(f"[Job {job_id}] 審計流程結束")
+    return {"id": job_id, "status": "completed" if completed_onchain else "reported", "report": report_url}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import logging
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AuditTask:
+    job_id: int
+    user: str
+    deadline: int  # paid_time + REFUND_DELAY（unix 秒），超過後使用者即可退款
+    est_cost: float  # 預估執行秒數（依原始碼大小）
+    run: Callable[[], Awaitable[Any]]
+    priority: int = 0  # slack 相同時數字小者優先
+    track_deadline: bool = True  # 預覽層等不影響退款的任務不計入 deadline 指標
+    droppable: bool = False  # slack 已為負時直接略過（預覽層），不佔用 worker
+    seq: int = 0
+    enqueued_at: float = field(default_factory=time.time)
+    future: Optional[asyncio.Future] = None
+
+    def slack(self, now: float) -> float:
+        return self.deadline - now - self.est_cost
+
+
+class AuditScheduler:
+    """
+    依 deadline 餘裕（slack = deadline - now - est_cost）排程審計任務：
+    - 餘裕最少者先跑，讓小合約不會被大合約拖過退款期限
+    - 每位使用者同時執行數不超過 max_per_user，避免單一客戶佔滿 worker
+    """
+
+    def __init__(self, concurrency: int = 2, max_per_user: int = 1):
+        self.concurrency = max(1, concurrency)
+        self.max_per_user = max(1, max_per_user)
+        self._queue: List[AuditTask] = []
+        self._running: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._metrics = {"submitted": 0, "finished": 0, "errors": 0, "deadline_missed": 0}
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+
+    def submit(self, task: AuditTask) -> asyncio.Future:
+        task.seq = next(self._seq)
+        task.future = asyncio.get_running_loop().create_future()
+        self._queue.append(task)
+        self._metrics["submitted"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return task.future
+
+    def _pick(self) -> Optional[AuditTask]:
+        now = time.time()
+        for t in [t for t in self._queue if t.droppable and t.slack(now) < 0]:
+            self._queue.remove(t)
+            logger.info(f"[Job {t.job_id}] slack 已為負，略過可捨棄任務")
+            if not t.future.done():
+                t.future.set_result({"id": t.job_id, "status": "skipped"})
+        eligible = [t for t in self._queue if self._running.get(t.user, 0) < self.max_per_user]
+        if not eligible:
+            return None
+        task = min(eligible, key=lambda t: (t.slack(now), t.priority, t.seq))
+        self._queue.remove(task)
+        return task
+
+    async def _worker(self, idx: int) -> None:
+        while True:
+            task = self._pick()
+            if task is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._running[task.user] = self._running.get(task.user, 0) + 1
+            started = time.time()
+            if task.track_deadline and started + task.est_cost > task.deadline:
+                logger.warning(f"[Job {task.job_id}] 預估無法於退款期限前完成（slack={task.slack(started):.0f}s）")
+            try:
+                result = await task.run()
+                if not task.future.done():
+                    task.future.set_result(result)
+            except Exception as e:
+                self._metrics["errors"] += 1
+                logger.error(f"[Job {task.job_id}] Scheduler worker {idx} error: {e}")
+                if not task.future.done():
+                    task.future.set_exception(e)
+            finally:
+                self._running[task.user] -= 1
+                if not self._running[task.user]:
+                    del self._running[task.user]
+                if task.track_deadline:
+                    self._metrics["finished"] += 1
+                    if time.time() > task.deadline:
+                        self._metrics["deadline_missed"] += 1
+                # 使用者名額釋出後，可能有其他 worker 等待的任務變為可執行
+                self._wakeup.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        finished = self._metrics["finished"]
+        return {
+            **self._metrics,
+            "deadline_miss_rate": (self._metrics["deadline_missed"] / finished) if finished else 0.0,
+            "queued": len(self._queue),
+            "running": sum(self._running.values()),
+            "concurrency": self.concurrency,
+            "max_per_user": self.max_per_user,
+        }
@@ -0,0 +1,117 @@
+import sqlite3
+from typing import Dict, Any, Optional, Tuple, Iterable
+
+# 聚合計數表：scope 為 ''（全域）或小寫使用者地址；amount 以字串存 wei，避免超出 SQLite 64-bit 整數
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS stats (
+  scope TEXT NOT NULL,
+  key TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  amount TEXT NOT NULL DEFAULT '0',
+  PRIMARY KEY (scope, key)
+);
+"""
+
+GLOBAL = ""
+# 計數定義變更時遞增，init_db 會據此全表重算
+VERSION = 2
+
+_SNAPSHOT_SQL = "SELECT id, user, amount, paid_block, completed, failed, fail_reason, refunded FROM cases"
+
+
+def _status(row: Dict[str, Any]) -> str:
+    if row.get("refunded"):
+        return "Refunded"
+    if row.get("completed"):
+        return "Completed"
+    if row.get("failed"):
+        return "Failed"
+    return "Pending"
+
+
+def _fail_kind(reason: Optional[str]) -> str:
+    # fail_reason 格式為 "<kind>: <detail>"，例如 slither_error / llm_error
+    kind = (reason or "").split(":", 1)[0].strip()
+    return kind or "unknown"
+
+
+def _contributions(row: Optional[Dict[str, Any]]) -> Dict[str, Tuple[int, int]]:
+    # paid_block 為 NULL 表示 JobPaid 已因 reorg 撤銷、尚未重新出現於鏈上，不計入
+    if not row or row.get("paid_block") is None:
+        return {}
+    amount = int(row.get("amount") or 0)
+    status = _status(row)
+    # 資金去向：已退款 / 已撥付 / 失敗待使用者退款 / 仍在託管中（審計進行中）
+    bucket = {"Refunded": "refunded", "Completed": "paid_out", "Failed": "pending_refund"}.get(status, "escrowed")
+    out = {
+        "cases": (1, amount),
+        f"status:{status}": (1, amount),
+        bucket: (1, amount),
+    }
+    if row.get("failed") and not row.get("completed"):
+        out[f"fail:{_fail_kind(row.get('fail_reason'))}"] = (1, amount)
+    return out
+
+
+def snapshot(conn: sqlite3.Connection, case_id: int) -> Optional[Dict[str, Any]]:
+    row = conn.execute(f"{_SNAPSHOT_SQL} WHERE id=?", (case_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def snapshot_where(conn: sqlite3.Connection, where: str, params: Iterable[Any]) -> Dict[int, Dict[str, Any]]:
+    rows = conn.execute(f"{_SNAPSHOT_SQL} WHERE {where}", tuple(params)).fetchall()
+    return {int(r["id"]): dict(r) for r in rows}
+
+
+def _bump(conn: sqlite3.Connection, scope: str, key: str, count: int, amount: int) -> None:
+    conn.execute("INSERT OR IGNORE INTO stats (scope, key) VALUES (?, ?)", (scope, key))
+    row = conn.execute("SELECT count, amount FROM stats WHERE scope=? AND key=?", (scope, key)).fetchone()
+    conn.execute(
+        "UPDATE stats SET count=?, amount=? WHERE scope=? AND key=?",
+        (int(row["count"]) + count, str(int(row["amount"]) + amount), scope, key),
+    )
+
+
+def apply_change(conn: sqlite3.Connection, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> None:
+    """依 case 變更前後快照調整計數；須與 case 變更在同一交易內呼叫。"""
+    deltas: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for row, sign in ((before, -1), (after, 1)):
+        if not row:
+            continue
+        for scope in (GLOBAL, str(row["user"]).lower()):
+            for key, (count, amount) in _contributions(row).items():
+                c, a = deltas.get((scope, key), (0, 0))
+                deltas[(scope, key)] = (c + sign * count, a + sign * amount)
+    for (scope, key), (count, amount) in deltas.items():
+        if count or amount:
+            _bump(conn, scope, key, count, amount)
+
+
+def rebuild(conn: sqlite3.Connection) -> None:
+    # 既有資料庫首次升級時全表重算一次；之後只做增量更新
+    conn.execute("DELETE FROM stats")
+    for row in conn.execute(_SNAPSHOT_SQL).fetchall():
+        apply_change(conn, None, dict(row))
+
+
+def read(conn: sqlite3.Connection, user: Optional[str] = None) -> Dict[str, Any]:
+    scope = user.lower() if user else GLOBAL
+    rows = conn.execute("SELECT key, count, amount FROM stats WHERE scope=?", (scope,)).fetchall()
+    counters = {r["key"]: (int(r["count"]), r["amount"]) for r in rows}
+    by_status = {
+        s: counters.get(f"status:{s}", (0, "0"))[0] for s in ("Pending", "Completed", "Failed", "Refunded")
+    }
+    failures = {k[len("fail:"):]: c for k, (c, _a) in counters.items() if k.startswith("fail:") and c}
+    return {
+        "scope": user or "global",
+        "cases": counters.get("cases", (0, "0"))[0],
+        "by_status": by_status,
+        "amount": {
+            "total": counters.get("cases", (0, "0"))[1],
+            "escrowed": counters.get("escrowed", (0, "0"))[1],
+            "paid_out": counters.get("paid_out", (0, "0"))[1],
+            "pending_refund": counters.get("pending_refund", (0, "0"))[1],
+            "refunded": counters.get("refunded", (0, "0"))[1],
+        },
+        "failures": failures,
+    }